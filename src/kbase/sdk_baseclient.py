@@ -2,13 +2,20 @@
 The base client for all SDK clients.
 """
 
+import asyncio as _asyncio
+import functools as _functools
+import httpx as _httpx
 import json as _json
-import random as _random
-import requests as _requests
 import os as _os
-from urllib.parse import urlparse as _urlparse
+import ssl as _ssl
+import time as _time
 from typing import Any
 
+try:
+    import orjson as _orjson
+except ImportError:
+    _orjson = None
+
 
 # The first version is a pretty basic port from the old baseclient, removing some no longer
 # relevant cruft.
@@ -17,10 +24,21 @@ from typing import Any
 __version__ = "0.1.0"
 
 
+# Method arguments are serialized as is, so tuples are accepted as well as lists
+_Params = list[Any] | tuple[Any, ...] | None
+
 _CT = "content-type"
 _AJ = "application/json"
-_URL_SCHEME = frozenset(["http", "https"])
+_URL_PREFIXES = ("http://", "https://")
 _CHECK_JOB_RETRIES = 3
+_HTTP_RETRIES = 3
+_HTTP_RETRY_STATUS = (502, 503, 504)
+_HTTP_RETRY_BACKOFF_SEC = 0.5
+# The request never reached the server, so it's always safe to retry
+_HTTP_RETRY_ERRORS = (_httpx.ConnectError, _httpx.ConnectTimeout)
+_MAX_ERROR_BODY = 4096
+# JSON larger than this is (de)serialized in a thread by the async client
+_ASYNC_OFFLOAD_SIZE = 256 * 1024
 
 
 class ServerError(Exception):
@@ -40,37 +58,109 @@ class ServerError(Exception):
             "\n" + self.data
 
 
-class _JSONObjectEncoder(_json.JSONEncoder):
+def _default(obj):
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
 
-    def default(self, obj):
-        if isinstance(obj, set):
-            return list(obj)
-        if isinstance(obj, frozenset):
-            return list(obj)
-        return _json.JSONEncoder.default(self, obj)
 
+def _dumps(obj: Any) -> bytes:
+    # Return bytes so httpx sends the body as is rather than encoding it again
+    if _orjson:
+        return _orjson.dumps(obj, default=_default)
+    return _json.dumps(obj, default=_default).encode("utf-8")
 
-class SDKBaseClient:
-    """
-    The KBase base client.
 
-    url - the url of the the service to contact:
-        For SDK methods: the url of the callback service.
-        For SDK dynamic services: the url of the Service Wizard.
-        For other services: the url of the service.
-    timeout - methods will fail if they take longer than this value in seconds.
-        Default 1800.
-    token - a KBase authentication token.
-    trust_all_ssl_certificates - set to True to trust self-signed certificates.
-        If you don't understand the implications, leave as the default, False.
-    lookup_url - set to true when contacting KBase dynamic services.
-    async_job_check_time_ms - the wait time between checking job state for
-        asynchronous jobs run with the run_job method.
-    async_job_check_time_scale_percent - the percentage increase in wait time between async job
-        check attempts.
-    async_job_check_max_time_ms - the maximum time to wait for a job check attempt before
-        failing.
-    """
+def _loads(data: bytes) -> Any:
+    # Both parsers accept UTF-8 bytes directly, so there's no need to decode to str first
+    if _orjson:
+        return _orjson.loads(data)
+    return _json.loads(data)
+
+
+def _exceeds_size(obj: Any, limit: int) -> bool:
+    # Cheaply estimates a lower bound for the JSON size of obj, stopping as soon as the limit is
+    # exceeded so large payloads aren't walked in full
+    size = 0
+    stack = [obj]
+    while stack:
+        o = stack.pop()
+        if isinstance(o, (str, bytes)):
+            size += len(o) + 2
+        elif isinstance(o, dict):
+            size += 2 + 4 * len(o)
+            if size <= limit:
+                stack.extend(o.keys())
+                stack.extend(o.values())
+        elif isinstance(o, (list, tuple, set, frozenset)):
+            size += 2 + len(o)
+            if size <= limit:
+                stack.extend(o)
+        else:
+            size += 1
+        if size > limit:
+            return True
+    return False
+
+
+def _error_text(body: bytes) -> str:
+    # Only decode the start of the body, error pages from misconfigured servers can be huge
+    return body[:_MAX_ERROR_BODY].decode("utf-8", errors="replace")
+
+
+def _read_error_body(ret: _httpx.Response) -> bytes:
+    # Reads no more of a streamed response than is needed for an error message
+    body = bytearray()
+    for chunk in ret.iter_bytes():
+        body += chunk
+        if len(body) >= _MAX_ERROR_BODY:
+            break
+    return bytes(body)
+
+
+async def _aread_error_body(ret: _httpx.Response) -> bytes:
+    # See _read_error_body
+    body = bytearray()
+    async for chunk in ret.aiter_bytes():
+        body += chunk
+        if len(body) >= _MAX_ERROR_BODY:
+            break
+    return bytes(body)
+
+
+def _is_transient(err: _httpx.HTTPError) -> bool:
+    if isinstance(err, _httpx.HTTPStatusError):
+        return err.response.status_code in _HTTP_RETRY_STATUS
+    return isinstance(err, _httpx.TransportError)
+
+
+@_functools.cache
+def _ssl_context(verify: bool) -> _ssl.SSLContext:
+    # Loading the CA bundle takes tens of milliseconds, so build each context once and share it
+    # between clients
+    return _httpx.create_ssl_context(verify=verify)
+
+
+class _BaseClient:
+    # Configuration and JSON-RPC handling shared between the sync and async clients.
+    # Subclasses set _client_class to the httpx client class to use.
+
+    _client_class: type[_httpx.Client] | type[_httpx.AsyncClient]
+
+    __slots__ = (
+        "url",
+        "timeout",
+        "_headers",
+        "trust_all_ssl_certificates",
+        "lookup_url",
+        "async_job_check_time",
+        "async_job_check_time_scale_percent",
+        "async_job_check_max_time",
+        "token",
+        "_verify",
+        "_client",
+    )
+
     def __init__(
             self,
             url: str,
@@ -85,12 +175,12 @@ class SDKBaseClient:
         ):
         if url is None:
             raise ValueError("A url is required")
-        scheme, _, _, _, _, _ = _urlparse(url)
-        if scheme not in _URL_SCHEME:
-            raise ValueError(url + " isn't a valid http url")
+        # schemes are case insensitive
+        if not isinstance(url, str) or not url[:8].lower().startswith(_URL_PREFIXES):
+            raise ValueError(f"{url} isn't a valid http url")
         self.url = url
         self.timeout = int(timeout)
-        self._headers = {}
+        self._headers = {"Content-Type": _AJ, "Accept": _AJ}
         self.trust_all_ssl_certificates = trust_all_ssl_certificates
         self.lookup_url = lookup_url
         self.async_job_check_time = async_job_check_time_ms / 1000.0
@@ -106,76 +196,423 @@ class SDKBaseClient:
             self._headers["AUTHORIZATION"] = self.token
         if self.timeout < 1:
             raise ValueError("Timeout value must be at least 1 second")
+        self._verify = _ssl_context(not self.trust_all_ssl_certificates)
+        # Don't pass a transport to the client, that disables the HTTP(S)_PROXY and NO_PROXY
+        # environment variables. Retries are handled in _post.
+        self._client = self._client_class(
+            http2=True,
+            verify=self._verify,
+            limits=_httpx.Limits(max_connections=10, max_keepalive_connections=5),
+            timeout=self.timeout,
+            headers=self._headers,
+            follow_redirects=True,  # matches the requests library behavior
+        )
 
-    def _call(
-        self, url: str, method: str, params: list[Any], context: dict[str, Any] | None = None
-    ):
-        arg_hash = {"method": method,
-                    "params": params,
-                    "version": "1.1",
-                    "id": str(_random.random())[2:],
-                    }
+    def _build_arg_hash(
+        self, method: str, params: _Params, context: dict[str, Any] | None
+    ) -> dict[str, Any]:
+        if params is None:
+            params = []
+        arg_hash = {
+            "method": method, "params": params, "version": "1.1", "id": _os.urandom(6).hex()
+        }
         if context:
             arg_hash["context"] = context
+        return arg_hash
 
-        body = _json.dumps(arg_hash, cls=_JSONObjectEncoder)
-        ret = _requests.post(
-            url,
-            data=body,
-            headers=self._headers,
-            timeout=self.timeout,
-            verify=not self.trust_all_ssl_certificates
-        )
-        ret.encoding = "utf-8"
+    def _is_readable(self, ret: _httpx.Response) -> bool:
+        # Successful responses and JSON-RPC errors are read in full. Anything else is an error
+        # page of unknown size.
+        return ret.is_success or (ret.status_code == 500 and ret.headers.get(_CT) == _AJ)
+
+    def _raise_error(self, ret: _httpx.Response, body_start: bytes):
+        # Handles responses that aren't readable
+        if ret.status_code == 500:
+            raise ServerError(
+                "Unknown", 0, f"The server returned a non-JSON response: {_error_text(body_start)}"
+            )
+        ret.raise_for_status()
+
+    def _get_result(self, ret: _httpx.Response) -> list[Any]:
+        # Expects a readable response that has been read
         if ret.status_code == 500:
-            if ret.headers.get(_CT) == _AJ:
-                err = ret.json()
-                if "error" in err:
-                    raise ServerError(**err["error"])
-                else:
-                    raise ServerError(
-                        "Unknown", 0, f"The server returned unexpected error JSON: {ret.text}"
-                    )
+            err = _loads(ret.content)
+            if "error" in err:
+                raise ServerError(**err["error"])
             else:
                 raise ServerError(
-                    "Unknown", 0, f"The server returned a non-JSON response: {ret.text}"
+                    "Unknown",
+                    0,
+                    f"The server returned unexpected error JSON: {_error_text(ret.content)}",
                 )
-        if not ret.ok:
-            ret.raise_for_status()
-        resp = ret.json()
+        resp = _loads(ret.content)
         if "result" not in resp:
             raise ServerError("Unknown", 0, "An unknown server error occurred")
-        if not resp["result"]:
+        return resp["result"] or []
+
+    def _unpack_result(self, result: list[Any]):
+        if not result:
             return None
-        if len(resp["result"]) == 1:
-            return resp["result"][0]
-        return resp["result"]
+        if len(result) == 1:
+            return result[0]
+        return result
+
+    def _job_check_waits(
+        self, async_job_check_time_ms: int | None, async_job_check_max_time_ms: int | None
+    ):
+        # Yields the wait before each job check attempt, scaling up to the maximum wait
+        wait = (self.async_job_check_time if async_job_check_time_ms is None
+                else async_job_check_time_ms / 1000.0)
+        max_wait = (self.async_job_check_max_time if async_job_check_max_time_ms is None
+                    else async_job_check_max_time_ms / 1000.0)
+        scale = self.async_job_check_time_scale_percent / 100.0
+        while True:
+            wait = min(wait, max_wait)
+            yield wait
+            wait *= scale
+
+    def _job_methods(self, service_method: str) -> tuple[str, str]:
+        mod, meth = service_method.split(".")
+        return f"{mod}._{meth}_submit", f"{mod}._check_job"
+
+    def _service_status_args(self, service_method: str, service_version: str | None):
+        service = service_method.split(".")[0]
+        return [{"module_name": service, "version": service_version}]
+
+    def _set_up_context(self, service_ver: str = None):
+        if service_ver:
+            return {"service_ver": service_ver}
+        return None
+
+
+class SDKBaseClient(_BaseClient):
+    """
+    The KBase base client.
+
+    url - the url of the the service to contact:
+        For SDK methods: the url of the callback service.
+        For SDK dynamic services: the url of the Service Wizard.
+        For other services: the url of the service.
+    timeout - methods will fail if they take longer than this value in seconds.
+        Default 1800.
+    token - a KBase authentication token.
+    trust_all_ssl_certificates - set to True to trust self-signed certificates.
+        If you don't understand the implications, leave as the default, False.
+    lookup_url - set to true when contacting KBase dynamic services.
+    async_job_check_time_ms - the wait time between checking job state for
+        asynchronous jobs run with the run_job method.
+    async_job_check_time_scale_percent - the percentage increase in wait time between async job
+        check attempts.
+    async_job_check_max_time_ms - the maximum time to wait for a job check attempt before
+        failing.
+
+    The client keeps a persistent HTTP/2 capable connection pool so that connections are reused
+    between calls. Call close(), or use the client as a context manager, to release the
+    connections.
+    """
+
+    __slots__ = ()
+    _client_class = _httpx.Client
+
+    def close(self):
+        """
+        Close the client's HTTP connection pool.
+        """
+        self._client.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _call(
+        self, url: str, method: str, params: _Params, context: dict[str, Any] | None = None
+    ):
+        return self._unpack_result(self._call_list(url, method, params, context))
+
+    def _call_single(
+        self, url: str, method: str, params: _Params, context: dict[str, Any] | None = None
+    ):
+        result = self._call_list(url, method, params, context)
+        return result[0] if result else None
+
+    def _call_list(
+        self, url: str, method: str, params: _Params, context: dict[str, Any] | None = None
+    ) -> list[Any]:
+        ret = self._post(url, _dumps(self._build_arg_hash(method, params, context)))
+        try:
+            if not self._is_readable(ret):
+                self._raise_error(ret, _read_error_body(ret))
+            ret.read()
+        finally:
+            ret.close()
+        return self._get_result(ret)
+
+    def _post(self, url: str, body: bytes) -> _httpx.Response:
+        # Connection failures and gateway errors are retried. Read failures and 500s are not,
+        # since the server may have already acted on the request, and 500s are JSON-RPC
+        # application errors.
+        # The response is streamed so that the body of an error response isn't read unless
+        # it's needed.
+        request = self._client.build_request("POST", url, content=body)
+        for attempt in range(_HTTP_RETRIES + 1):
+            try:
+                ret = self._client.send(request, stream=True)
+            except _HTTP_RETRY_ERRORS:
+                if attempt == _HTTP_RETRIES:
+                    raise
+            else:
+                if ret.status_code not in _HTTP_RETRY_STATUS or attempt == _HTTP_RETRIES:
+                    return ret
+                ret.close()
+            _time.sleep(_HTTP_RETRY_BACKOFF_SEC * 2 ** attempt)
 
     def _get_service_url(self, service_method: str, service_version: str | None):
         if not self.lookup_url:
             return self.url
-        service = service_method.split(".")[0]
         service_status_ret = self._call(
             self.url, "ServiceWizard.get_service_status",
-            [{"module_name": service, "version": service_version}]
+            self._service_status_args(service_method, service_version)
         )
         return service_status_ret["url"]
 
-    def _set_up_context(self, service_ver: str = None):
-        if service_ver:
-            return {"service_ver": service_ver}
-        return None
-
-    def call_method(self, service_method: str, args: list[Any], *, service_ver: str | None = None):
+    def call_method(
+        self,
+        service_method: str,
+        args: _Params,
+        *,
+        service_ver: str | None = None,
+        returns_list: bool | None = None,
+    ):
         """
         Call a standard or dynamic service synchronously.
         Required arguments:
         service_method - the service and method to run, e.g. myserv.mymeth.
-        args - a list of arguments to the method.
+        args - a list or tuple of arguments to the method. None is treated as no arguments.
         Optional arguments:
         service_ver - the version of the service to run, e.g. a git hash
             or dev/beta/release.
+        returns_list - True to always return the list of the method's return values, False to
+            return the first return value or None if there isn't one. By default the list is
+            returned unless it has less than two values, in which case the value or None is
+            returned.
         """
         url = self._get_service_url(service_method, service_ver)
         context = self._set_up_context(service_ver)
-        return self._call(url, service_method, args, context)
+        if returns_list is None:
+            return self._call(url, service_method, args, context)
+        if returns_list:
+            return self._call_list(url, service_method, args, context)
+        return self._call_single(url, service_method, args, context)
+
+    def run_job(
+        self,
+        service_method: str,
+        args: _Params,
+        *,
+        service_ver: str | None = None,
+        async_job_check_time_ms: int | None = None,
+        async_job_check_max_time_ms: int | None = None,
+    ):
+        """
+        Run a SDK method as an asynchronous job via the callback service and wait for the
+        results. The job is always submitted to the client url, even if lookup_url is set.
+        Required arguments:
+        service_method - the service and method to run, e.g. myserv.mymeth.
+        args - a list or tuple of arguments to the method. None is treated as no arguments.
+        Optional arguments:
+        service_ver - the version of the service to run, e.g. a git hash
+            or dev/beta/release.
+        async_job_check_time_ms - overrides the client's initial wait time between job checks.
+        async_job_check_max_time_ms - overrides the client's maximum wait time between job
+            checks.
+        """
+        # Jobs are run by the callback service, not the service itself
+        url = self.url
+        submit, check = self._job_methods(service_method)
+        job_id = self._call(url, submit, args, self._set_up_context(service_ver))
+        failures = 0
+        for wait in self._job_check_waits(async_job_check_time_ms, async_job_check_max_time_ms):
+            _time.sleep(wait)
+            try:
+                job_state = self._call(url, check, [job_id])
+            except _httpx.HTTPError as e:
+                if not _is_transient(e):
+                    raise
+                failures += 1
+                if failures >= _CHECK_JOB_RETRIES:
+                    raise RuntimeError(
+                        f"_check_job failed {failures} times and exceeded limit") from e
+                continue
+            # Only consecutive failures count against the limit
+            failures = 0
+            if job_state["finished"]:
+                return self._unpack_result(job_state["result"])
+
+
+class AsyncSDKBaseClient(_BaseClient):
+    """
+    The asyncio based KBase base client.
+
+    Takes the same arguments as SDKBaseClient. Calls made concurrently, e.g. with
+    asyncio.gather, share the client's connection pool.
+
+    Call close(), or use the client as an async context manager, to release the connections.
+    """
+
+    __slots__ = ()
+    _client_class = _httpx.AsyncClient
+
+    async def close(self):
+        """
+        Close the client's HTTP connection pool.
+        """
+        await self._client.aclose()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def _call(
+        self, url: str, method: str, params: _Params, context: dict[str, Any] | None = None
+    ):
+        return self._unpack_result(await self._call_list(url, method, params, context))
+
+    async def _call_single(
+        self, url: str, method: str, params: _Params, context: dict[str, Any] | None = None
+    ):
+        result = await self._call_list(url, method, params, context)
+        return result[0] if result else None
+
+    async def _call_list(
+        self, url: str, method: str, params: _Params, context: dict[str, Any] | None = None
+    ) -> list[Any]:
+        # Avoid blocking the event loop while (de)serializing large payloads. Small payloads
+        # are handled inline since handing off to a thread costs more than the serialization.
+        arg_hash = self._build_arg_hash(method, params, context)
+        if _exceeds_size(params, _ASYNC_OFFLOAD_SIZE):
+            body = await _asyncio.to_thread(_dumps, arg_hash)
+        else:
+            body = _dumps(arg_hash)
+        ret = await self._post(url, body)
+        try:
+            if not self._is_readable(ret):
+                self._raise_error(ret, await _aread_error_body(ret))
+            await ret.aread()
+        finally:
+            await ret.aclose()
+        if len(ret.content) > _ASYNC_OFFLOAD_SIZE:
+            return await _asyncio.to_thread(self._get_result, ret)
+        return self._get_result(ret)
+
+    async def _post(self, url: str, body: bytes) -> _httpx.Response:
+        # See SDKBaseClient._post
+        request = self._client.build_request("POST", url, content=body)
+        for attempt in range(_HTTP_RETRIES + 1):
+            try:
+                ret = await self._client.send(request, stream=True)
+            except _HTTP_RETRY_ERRORS:
+                if attempt == _HTTP_RETRIES:
+                    raise
+            else:
+                if ret.status_code not in _HTTP_RETRY_STATUS or attempt == _HTTP_RETRIES:
+                    return ret
+                await ret.aclose()
+            await _asyncio.sleep(_HTTP_RETRY_BACKOFF_SEC * 2 ** attempt)
+
+    async def _get_service_url(self, service_method: str, service_version: str | None):
+        if not self.lookup_url:
+            return self.url
+        service_status_ret = await self._call(
+            self.url, "ServiceWizard.get_service_status",
+            self._service_status_args(service_method, service_version)
+        )
+        return service_status_ret["url"]
+
+    async def call_method(
+        self,
+        service_method: str,
+        args: _Params,
+        *,
+        service_ver: str | None = None,
+        returns_list: bool | None = None,
+    ):
+        """
+        Call a standard or dynamic service asynchronously.
+        See SDKBaseClient.call_method for the arguments.
+        """
+        url = await self._get_service_url(service_method, service_ver)
+        context = self._set_up_context(service_ver)
+        if returns_list is None:
+            return await self._call(url, service_method, args, context)
+        if returns_list:
+            return await self._call_list(url, service_method, args, context)
+        return await self._call_single(url, service_method, args, context)
+
+    async def call_methods(
+        self, calls: list[tuple[str, _Params]], *, service_ver: str | None = None
+    ) -> list[Any]:
+        """
+        Call several standard or dynamic service methods concurrently. The calls must not
+        depend on each other's results.
+
+        The calls share the client's connection pool, and over HTTP/2 may be multiplexed on the
+        same connection.
+
+        Required arguments:
+        calls - a list of (service_method, args) tuples, as would be passed to call_method.
+        Optional arguments:
+        service_ver - the version of the service to run for all the calls.
+
+        Returns the results in the same order as the calls. If any call fails, the remaining
+        calls are cancelled and the first exception is raised.
+        """
+        tasks = [
+            _asyncio.create_task(self.call_method(m, a, service_ver=service_ver))
+            for m, a in calls
+        ]
+        try:
+            return await _asyncio.gather(*tasks)
+        finally:
+            # no-op for finished tasks. Wait for the cancellations so the client isn't closed
+            # under running calls and their exceptions are retrieved
+            for t in tasks:
+                t.cancel()
+            await _asyncio.gather(*tasks, return_exceptions=True)
+
+    async def run_job(
+        self,
+        service_method: str,
+        args: _Params,
+        *,
+        service_ver: str | None = None,
+        async_job_check_time_ms: int | None = None,
+        async_job_check_max_time_ms: int | None = None,
+    ):
+        """
+        Run a SDK method as an asynchronous job and wait for the results without blocking the
+        event loop. See SDKBaseClient.run_job for the arguments.
+        """
+        url = self.url
+        submit, check = self._job_methods(service_method)
+        job_id = await self._call(url, submit, args, self._set_up_context(service_ver))
+        failures = 0
+        for wait in self._job_check_waits(async_job_check_time_ms, async_job_check_max_time_ms):
+            await _asyncio.sleep(wait)
+            try:
+                job_state = await self._call(url, check, [job_id])
+            except _httpx.HTTPError as e:
+                if not _is_transient(e):
+                    raise
+                failures += 1
+                if failures >= _CHECK_JOB_RETRIES:
+                    raise RuntimeError(
+                        f"_check_job failed {failures} times and exceeded limit") from e
+                continue
+            # Only consecutive failures count against the limit
+            failures = 0
+            if job_state["finished"]:
+                return self._unpack_result(job_state["result"])
@@ -1,19 +1,21 @@
+import asyncio
 from configparser import ConfigParser
-from http.server import BaseHTTPRequestHandler, HTTPServer
 import json
 import os
 import pytest
+from pytest_httpserver import HTTPServer
 import re
-from requests.exceptions import HTTPError, ReadTimeout
+from httpx import ConnectError, HTTPStatusError, ReadTimeout
 import semver
-import threading
+import socket
+import ssl
 import time
+from werkzeug import Request, Response
 
 from kbase import sdk_baseclient
 
 
 _VERSION = "0.1.0"
-_MOCKSERVER_PORT = 31590  # should be fine, find an empty port otherwise
 
 
 @pytest.fixture(scope="module")
@@ -24,34 +26,94 @@ def url_and_token():
     return sec["test_url"], sec["test_token"]
 
 
-class MockHandler(BaseHTTPRequestHandler):
-    def do_POST(self):
-        if self.path == "/not-json":
-            self.send_response(500)
-            self.send_header("Content-Type", "text/plain")
-            self.end_headers()
-            self.wfile.write(b"Wrong server pal")
-        elif self.path == "/missing-error":
-            self.send_response(500)
-            self.send_header("Content-Type", "application/json")
-            self.end_headers()
-            self.wfile.write(json.dumps({"oops": "no error key"}).encode("utf-8"))
-        else:
-            self.send_response(500)
-            self.send_header("Content-Type", "application/json")
-            self.end_headers()
-            self.wfile.write(b"Don't call this endpoint chum")
+def _json_response(obj, status: int = 200, content_type: str = "application/json"):
+    return Response(json.dumps(obj), status=status, content_type=content_type)
+
+
+class MockHandler:
+    flaky_calls = 0
+    jobs = {}
+    endless_chunks_sent = 0
+
+    @classmethod
+    def handle(cls, request: Request) -> Response:
+        body = json.loads(request.get_data())
+        match request.path:
+            case "/echo":
+                return _json_response({"result": body["params"]})
+            case "/job" | "/job-check-down" | "/job-check-intermittent":
+                return cls._handle_job(request.path, body)
+            case "/wrong-charset":
+                # JSON is always UTF-8, whatever the server claims
+                return Response(
+                    json.dumps({"result": ["Ω→"]}, ensure_ascii=False).encode("utf-8"),
+                    content_type="application/json; charset=iso-8859-1",
+                )
+            case "/flaky":
+                # fail twice, then succeed
+                cls.flaky_calls += 1
+                if cls.flaky_calls % 3:
+                    return Response(status=503)
+                return _json_response({"result": ["ok"]})
+            case "/unavailable":
+                return Response(status=502)
+            case "/not-json":
+                return Response(b"Wrong server pal", status=500, content_type="text/plain")
+            case "/huge-not-json":
+                return Response(b"x" * 100000, status=500, content_type="text/html")
+            case "/endless-not-json":
+                return Response(cls._endless_body(), status=500, content_type="text/html")
+            case "/missing-error":
+                return _json_response({"oops": "no error key"}, status=500)
+            case _:
+                return Response(
+                    b"Don't call this endpoint chum", status=500, content_type="application/json"
+                )
+
+    @classmethod
+    def _endless_body(cls):
+        # 64 MiB, far more than the client should ever read for an error message
+        for _ in range(1024):
+            cls.endless_chunks_sent += 1
+            yield b"x" * 65536
+
+    @classmethod
+    def _handle_job(cls, path: str, body: dict):
+        # jobs finish on the 3rd check and return their parameters
+        if body["method"].endswith("_submit"):
+            job_id = f"job{len(cls.jobs)}"
+            cls.jobs[job_id] = {"checks": 0, "requests": 0, "params": body["params"]}
+            return _json_response({"result": [job_id]})
+        if path == "/job-check-down":
+            return Response(status=503)
+        job = cls.jobs[body["params"][0]]
+        if path == "/job-check-intermittent":
+            # 4 503s fail a check after the HTTP retries, so checks alternate between failing
+            # and succeeding
+            job["requests"] += 1
+            if job["requests"] % 5:
+                return Response(status=503)
+        job["checks"] += 1
+        finished = job["checks"] >= 3
+        return _json_response({"result": [{
+            "finished": int(finished), "result": job["params"] if finished else None
+        }]})
 
 
 @pytest.fixture(scope="module")
 def mockserver():
-    server = HTTPServer(("localhost", _MOCKSERVER_PORT), MockHandler)
-    thread = threading.Thread(target=server.serve_forever, daemon=True)
-    thread.start()
-    
-    yield f"http://localhost:{_MOCKSERVER_PORT}"
-    
-    server.shutdown()
+    # Listens on an ephemeral port. Threaded so that a connection abandoned by a cancelled
+    # concurrent call can't block the server.
+    server = HTTPServer(threaded=True)
+    server.expect_request(re.compile("/.*"), method="POST").respond_with_handler(
+        MockHandler.handle
+    )
+    server.start()
+
+    yield server.url_for("/").rstrip("/")
+
+    server.clear()
+    server.stop()
 
 
 def test_version():
@@ -61,6 +123,8 @@ def test_version():
 def test_construct_fail():
     _test_construct_fail(None, 1, "A url is required")
     _test_construct_fail("ftp://foo.com/bar", 1, "ftp://foo.com/bar isn't a valid http url")
+    _test_construct_fail("httpx://foo.com", 1, "httpx://foo.com isn't a valid http url")
+    _test_construct_fail("foo.com", 1, "foo.com isn't a valid http url")
     for t in [.999999, 0, -1, -1000]:
         _test_construct_fail("http://example.com", t, "Timeout value must be at least 1 second")
 
@@ -70,6 +134,17 @@ def _test_construct_fail(url: str, timeout: int, expected: str):
         sdk_baseclient.SDKBaseClient(url, timeout=timeout)
 
 
+@pytest.mark.parametrize("use_orjson", [True, False])
+def test_json_round_trip(monkeypatch, use_orjson):
+    if not use_orjson:
+        monkeypatch.setattr(sdk_baseclient, "_orjson", None)
+    body = sdk_baseclient._dumps({"s": set(["a"]), "f": frozenset(["b"]), "u": "Ω"})
+    assert isinstance(body, bytes)
+    assert sdk_baseclient._loads(body) == {"s": ["a"], "f": ["b"], "u": "Ω"}
+    with pytest.raises(TypeError):
+        sdk_baseclient._dumps({"o": object()})
+
+
 def test_tokenless(url_and_token):
     bc = sdk_baseclient.SDKBaseClient(url_and_token[0] + "/services/ws")
     res = bc.call_method("Workspace.ver", [])
@@ -169,17 +244,14 @@ def test_call_method_error(url_and_token):
 
 def test_error_non_500(url_and_token):
     bc = sdk_baseclient.SDKBaseClient(url_and_token[0] + "/services/wsfake")
-    err = "404 Client Error: Not Found for url: https://ci.kbase.us//services/wsfake"
-    with pytest.raises(HTTPError, match=err):
+    err = re.escape("Client error '404 Not Found' for url 'https://ci.kbase.us//services/wsfake'")
+    with pytest.raises(HTTPStatusError, match=err):
         bc.call_method("Workspace.ver", [])
 
 
 def test_timeout():
     bc = sdk_baseclient.SDKBaseClient("https://httpbin.org/delay/10", timeout=1)
-    err = re.escape(
-        "HTTPSConnectionPool(host='httpbin.org', port=443): Read timed out. (read timeout=1)"
-    )
-    with pytest.raises(ReadTimeout, match=err):
+    with pytest.raises(ReadTimeout):
         bc.call_method("Workspace.ver", [])
 
 
@@ -193,6 +265,97 @@ def test_missing_result_key():
     assert got.value.data == ""
 
 
+def _closed_port_url():
+    with socket.socket() as s:
+        s.bind(("localhost", 0))
+        return f"http://localhost:{s.getsockname()[1]}"
+
+
+def test_retry_connection_failures(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(sdk_baseclient._time, "sleep", sleeps.append)
+    bc = sdk_baseclient.SDKBaseClient(_closed_port_url())
+    with pytest.raises(ConnectError):
+        bc.call_method("Workspace.ver", [])
+    assert sleeps == [0.5, 1.0, 2.0]
+
+
+def test_call_method_returns_list(mockserver):
+    bc = sdk_baseclient.SDKBaseClient(mockserver + "/echo")
+    for args, default, single, as_list in [
+        ([], None, None, []),
+        ([[1]], [1], [1], [[1]]),
+        ([1, 2], [1, 2], 1, [1, 2]),
+    ]:
+        assert bc.call_method("Mod.meth", args) == default
+        assert bc.call_method("Mod.meth", args, returns_list=False) == single
+        assert bc.call_method("Mod.meth", args, returns_list=True) == as_list
+
+
+@pytest.mark.parametrize("use_orjson", [True, False])
+def test_response_parsed_as_utf8(mockserver, monkeypatch, use_orjson):
+    if not use_orjson:
+        monkeypatch.setattr(sdk_baseclient, "_orjson", None)
+    bc = sdk_baseclient.SDKBaseClient(mockserver + "/wrong-charset")
+    assert bc.call_method("Mod.meth", []) == "Ω→"
+
+
+def test_call_method_params(mockserver):
+    bc = sdk_baseclient.SDKBaseClient(mockserver + "/echo")
+    assert bc.call_method("Mod.meth", None, returns_list=True) == []
+    assert bc.call_method("Mod.meth", (1, (2, 3))) == [1, [2, 3]]
+
+
+def test_retry_transient_errors(mockserver):
+    MockHandler.flaky_calls = 0
+    bc = sdk_baseclient.SDKBaseClient(mockserver + "/flaky")
+    assert bc.call_method("Workspace.ver", []) == "ok"
+    assert MockHandler.flaky_calls == 3
+
+
+def test_retry_exhausted(mockserver):
+    bc = sdk_baseclient.SDKBaseClient(mockserver + "/unavailable")
+    with pytest.raises(HTTPStatusError, match="Server error '502"):
+        bc.call_method("Workspace.ver", [])
+
+
+def test_job_check_waits():
+    bc = sdk_baseclient.SDKBaseClient(
+        "http://example.com",
+        async_job_check_time_ms=100,
+        async_job_check_time_scale_percent=150,
+        async_job_check_max_time_ms=300,
+    )
+    waits = bc._job_check_waits(None, None)
+    assert [next(waits) for _ in range(5)] == pytest.approx([0.1, 0.15, 0.225, 0.3, 0.3])
+    waits = bc._job_check_waits(10, 20)
+    assert [next(waits) for _ in range(3)] == pytest.approx([0.01, 0.015, 0.02])
+
+
+def test_run_job(mockserver):
+    bc = sdk_baseclient.SDKBaseClient(mockserver + "/job", async_job_check_time_ms=10)
+    assert bc.run_job("Mod.meth", [{"a": 1}]) == {"a": 1}
+    assert bc.run_job("Mod.meth", [{"a": 1}, 2], service_ver="dev") == [{"a": 1}, 2]
+    # the Service Wizard is never contacted
+    bc = sdk_baseclient.SDKBaseClient(
+        mockserver + "/job", async_job_check_time_ms=10, lookup_url=True
+    )
+    assert bc.run_job("Mod.meth", ["b"]) == "b"
+
+
+def test_run_job_intermittent_check_failures(mockserver, monkeypatch):
+    monkeypatch.setattr(sdk_baseclient, "_HTTP_RETRY_BACKOFF_SEC", 0)
+    bc = sdk_baseclient.SDKBaseClient(mockserver + "/job-check-intermittent")
+    assert bc.run_job("Mod.meth", ["c"], async_job_check_time_ms=1) == "c"
+
+
+def test_run_job_check_failures(mockserver, monkeypatch):
+    monkeypatch.setattr(sdk_baseclient, "_HTTP_RETRY_BACKOFF_SEC", 0)
+    bc = sdk_baseclient.SDKBaseClient(mockserver + "/job-check-down")
+    with pytest.raises(RuntimeError, match="_check_job failed 3 times and exceeded limit"):
+        bc.run_job("Mod.meth", [], async_job_check_time_ms=1)
+
+
 def test_not_application_json(mockserver):
     bc = sdk_baseclient.SDKBaseClient(mockserver + "/not-json")
     with pytest.raises(sdk_baseclient.ServerError) as got:
@@ -203,6 +366,24 @@ def test_not_application_json(mockserver):
     assert got.value.data == ""
 
 
+def test_not_application_json_truncated(mockserver):
+    bc = sdk_baseclient.SDKBaseClient(mockserver + "/huge-not-json")
+    with pytest.raises(sdk_baseclient.ServerError) as got:
+        bc.call_method("Workspace.ver", [])
+    assert got.value.message == "The server returned a non-JSON response: " + "x" * 4096
+
+
+def test_not_application_json_body_not_read(mockserver):
+    MockHandler.endless_chunks_sent = 0
+    bc = sdk_baseclient.SDKBaseClient(mockserver + "/endless-not-json")
+    with pytest.raises(sdk_baseclient.ServerError) as got:
+        bc.call_method("Workspace.ver", [])
+    assert got.value.message == "The server returned a non-JSON response: " + "x" * 4096
+    # the server stops sending once the client closes the connection. Allow for whatever
+    # the socket buffers absorb.
+    assert MockHandler.endless_chunks_sent < 512
+
+
 def test_missing_error_key(mockserver):
     bc = sdk_baseclient.SDKBaseClient(mockserver + "/missing-error")
     with pytest.raises(sdk_baseclient.ServerError) as got:
@@ -215,6 +396,189 @@ def test_missing_error_key(mockserver):
     assert got.value.data == ""
 
 
+def test_construct_url_scheme():
+    for url in ["http://foo.com", "https://foo.com", "HTTPS://foo.com"]:
+        assert sdk_baseclient.SDKBaseClient(url).url == url
+
+
+def test_no_instance_dict():
+    for cls in [sdk_baseclient.SDKBaseClient, sdk_baseclient.AsyncSDKBaseClient]:
+        bc = cls("http://example.com")
+        assert not hasattr(bc, "__dict__")
+        with pytest.raises(AttributeError):
+            bc.foo = "bar"
+
+
+def test_ssl_context_shared():
+    bc1 = sdk_baseclient.SDKBaseClient("https://example.com")
+    bc2 = sdk_baseclient.AsyncSDKBaseClient("https://example.com")
+    assert bc1._verify is bc2._verify
+    assert bc1._verify.verify_mode == ssl.CERT_REQUIRED
+    bc3 = sdk_baseclient.SDKBaseClient("https://example.com", trust_all_ssl_certificates=True)
+    assert bc3._verify.verify_mode == ssl.CERT_NONE
+
+
+def test_proxy_env(monkeypatch):
+    monkeypatch.setenv("HTTPS_PROXY", "http://proxy.example.com:3128")
+    for cls in [sdk_baseclient.SDKBaseClient, sdk_baseclient.AsyncSDKBaseClient]:
+        bc = cls("https://example.com")
+        assert "https://" in [p.pattern for p in bc._client._mounts]
+
+
+def test_headers():
+    bc = sdk_baseclient.SDKBaseClient("http://example.com", token="tok")
+    for k, v in {
+        "Content-Type": "application/json", "Accept": "application/json", "AUTHORIZATION": "tok"
+    }.items():
+        assert bc._client.headers[k] == v
+    bc = sdk_baseclient.SDKBaseClient("http://example.com")
+    assert "AUTHORIZATION" not in bc._client.headers
+
+
+def test_context_manager(mockserver):
+    with sdk_baseclient.SDKBaseClient(mockserver + "/not-json") as bc:
+        for _ in range(2):
+            with pytest.raises(sdk_baseclient.ServerError):
+                bc.call_method("Workspace.ver", [])
+        assert not bc._client.is_closed
+    assert bc._client.is_closed
+
+
+###
+# Async client tests
+#
+# The async client shares request building and response handling with the sync client, so
+# we only test the async specific code paths.
+###
+
+def test_async_construct_fail():
+    with pytest.raises(ValueError, match="ftp://foo.com isn't a valid http url"):
+        sdk_baseclient.AsyncSDKBaseClient("ftp://foo.com")
+
+
+def test_async_call_method(mockserver):
+    async def run():
+        async with sdk_baseclient.AsyncSDKBaseClient(mockserver + "/echo") as bc:
+            res = await asyncio.gather(*[bc.call_method("Mod.meth", [i]) for i in range(5)])
+        assert bc._client.is_closed
+        return res
+
+    assert asyncio.run(run()) == [0, 1, 2, 3, 4]
+
+
+def test_async_call_method_returns_list(mockserver):
+    async def run():
+        async with sdk_baseclient.AsyncSDKBaseClient(mockserver + "/echo") as bc:
+            return [
+                await bc.call_method("Mod.meth", [[1]], returns_list=True),
+                await bc.call_method("Mod.meth", [1, 2], returns_list=False),
+            ]
+
+    assert asyncio.run(run()) == [[[1]], 1]
+
+
+def test_async_retry_connection_failures(monkeypatch):
+    monkeypatch.setattr(sdk_baseclient, "_HTTP_RETRY_BACKOFF_SEC", 0)
+
+    async def run():
+        async with sdk_baseclient.AsyncSDKBaseClient(_closed_port_url()) as bc:
+            await bc.call_method("Workspace.ver", [])
+
+    with pytest.raises(ConnectError):
+        asyncio.run(run())
+
+
+def test_async_call_methods(mockserver):
+    async def run(path):
+        async with sdk_baseclient.AsyncSDKBaseClient(mockserver + path) as bc:
+            return await bc.call_methods([("Mod.meth", [1]), ("Mod.meth2", (2, 3)), ("M.m", [])])
+
+    assert asyncio.run(run("/echo")) == [1, [2, 3], None]
+    with pytest.raises(sdk_baseclient.ServerError, match="non-JSON response"):
+        asyncio.run(run("/not-json"))
+
+
+def test_async_retry_transient_errors(mockserver):
+    async def run():
+        async with sdk_baseclient.AsyncSDKBaseClient(mockserver + "/flaky") as bc:
+            return await bc.call_method("Workspace.ver", [])
+
+    MockHandler.flaky_calls = 0
+    assert asyncio.run(run()) == "ok"
+    assert MockHandler.flaky_calls == 3
+
+
+def test_exceeds_size():
+    for obj, limit, expected in [
+        ("x" * 98, 100, False),
+        ("x" * 99, 100, True),
+        ([1] * 40, 100, False),
+        ([1] * 200, 100, True),
+        ({"a": ["x" * 100]}, 100, True),
+        ({"a": ["x" * 10]}, 100, False),
+        ([frozenset([("y" * 10, "z" * 10)])] * 4, 100, True),
+        (None, 0, True),
+    ]:
+        assert sdk_baseclient._exceeds_size(obj, limit) is expected, obj
+
+
+def test_async_large_payload(mockserver, monkeypatch):
+    threaded = []
+    to_thread = asyncio.to_thread
+
+    async def record_to_thread(func, *args):
+        threaded.append(func.__name__)
+        return await to_thread(func, *args)
+
+    monkeypatch.setattr(asyncio, "to_thread", record_to_thread)
+
+    async def run(args):
+        async with sdk_baseclient.AsyncSDKBaseClient(mockserver + "/echo") as bc:
+            return await bc.call_method("Mod.meth", args)
+
+    assert asyncio.run(run([{"a": 1}])) == {"a": 1}
+    assert threaded == []
+    big = "x" * 300000
+    assert asyncio.run(run([{"a": big}])) == {"a": big}
+    assert threaded == ["_dumps", "_get_result"]
+
+
+def test_async_not_application_json_body_not_read(mockserver):
+    async def run():
+        async with sdk_baseclient.AsyncSDKBaseClient(mockserver + "/endless-not-json") as bc:
+            await bc.call_method("Workspace.ver", [])
+
+    MockHandler.endless_chunks_sent = 0
+    with pytest.raises(sdk_baseclient.ServerError) as got:
+        asyncio.run(run())
+    assert got.value.message == "The server returned a non-JSON response: " + "x" * 4096
+    assert MockHandler.endless_chunks_sent < 512
+
+
+def test_async_missing_error_key(mockserver):
+    async def run():
+        async with sdk_baseclient.AsyncSDKBaseClient(mockserver + "/missing-error") as bc:
+            await bc.call_method("Workspace.ver", [])
+
+    with pytest.raises(sdk_baseclient.ServerError) as got:
+        asyncio.run(run())
+    assert got.value.message == (
+        'The server returned unexpected error JSON: {"oops": "no error key"}'
+    )
+
+
+def test_async_run_job(mockserver, monkeypatch):
+    async def run(path):
+        async with sdk_baseclient.AsyncSDKBaseClient(mockserver + path) as bc:
+            return await bc.run_job("Mod.meth", [["a"]], async_job_check_time_ms=10)
+
+    assert asyncio.run(run("/job")) == ["a"]
+    monkeypatch.setattr(sdk_baseclient, "_HTTP_RETRY_BACKOFF_SEC", 0)
+    assert asyncio.run(run("/job-check-intermittent")) == ["a"]
+    with pytest.raises(RuntimeError, match="_check_job failed 3 times and exceeded limit"):
+        asyncio.run(run("/job-check-down"))
+
+
 ###
 # Dynamic service tests
 # 